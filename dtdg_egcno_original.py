@@ -1,61 +1,155 @@
 import torch
-import numpy as np
 import torch.nn.functional as F
 from torch_geometric_temporal.nn.recurrent import EvolveGCNO
 from torch_geometric.utils.negative_sampling import negative_sampling
-from tgb.linkproppred.evaluate import Evaluator
 from tgb.linkproppred.negative_sampler import NegativeEdgeSampler
 import wandb
 import timeit
+from concurrent.futures import ThreadPoolExecutor
+
+class CSRFixedWConv(torch.nn.Module):
+    r"""
+    replaces the GCNConv_Fixed_W of EvolveGCNO, propagates with a precomputed normalized
+    CSR adjacency, one sparse matmul per snapshot instead of PyG's scatter based message passing
+    """
+    def forward(self, W, x, adj, edge_weight=None):
+        #* sparse matmul has no bf16 autocast rule, propagate in the dtype of the adjacency
+        return torch.sparse.mm(adj, (x @ W).to(adj.dtype))
+
+
+class CSREvolveGCNO(EvolveGCNO):
+    r"""
+    EvolveGCNO that takes the normalized adjacency from `gcn_norm_csr` in place of the edge index,
+    the weight evolution is left to EvolveGCNO.forward
+    """
+    def __init__(self, in_channels):
+        super(CSREvolveGCNO, self).__init__(in_channels)
+        self.conv_layer = CSRFixedWConv()
+
+    def forward(self, X, adj):
+        r"""
+        X: node feature matrix
+        adj: normalized adjacency of the snapshot from `gcn_norm_csr`
+        """
+        return super(CSREvolveGCNO, self).forward(X, adj)
+
 
 #https://github.com/benedekrozemberczki/pytorch_geometric_temporal/blob/master/examples/recurrent/evolvegcno_example.py
 class RecurrentGCN(torch.nn.Module):
-    def __init__(self, node_feat_dim, hidden_dim):
+    def __init__(self, node_feat_dim, hidden_dim, num_nodes, amp=False):
         super(RecurrentGCN, self).__init__()
-        self.recurrent = EvolveGCNO(node_feat_dim)
+        self.recurrent = CSREvolveGCNO(node_feat_dim)
         self.linear = torch.nn.Linear(node_feat_dim, hidden_dim)
+        self.amp = amp #bf16 autocast of the forward, embeddings are returned in fp32
+        #* fixed random node features, a buffer so they move with the model and keep a stable address
+        self.register_buffer('node_feat', torch.randn((num_nodes, node_feat_dim)))
 
-    def forward(self, x, edge_index, edge_weight):
-        h = self.recurrent(x, edge_index, edge_weight)
-        h = F.relu(h)
-        h = self.linear(h)
-        return h
+    def forward(self, adj):
+        x = self.node_feat
+        with torch.autocast(device_type=x.device.type, dtype=torch.bfloat16, enabled=self.amp, cache_enabled=False):
+            h = self.recurrent(x, adj)
+            h = F.relu(h)
+            h = self.linear(h)
+        return h.float()
 
 
 
 class LinkPredictor(torch.nn.Module):
-    def __init__(self, in_channels, hidden_channels, out_channels, num_layers,
-                 dropout):
+    r"""
+    factorized bilinear link predictor, logit(i, j) = <W_i x_i, W_j x_j> + b
+    the two projections are independent so that a batch of sources can be scored
+    against a batch of candidates with one matrix multiplication
+    """
+    def __init__(self, in_channels, hidden_channels, dropout, amp=False):
         super(LinkPredictor, self).__init__()
-
-        self.lins = torch.nn.ModuleList()
-        self.lins.append(torch.nn.Linear(in_channels, hidden_channels))
-        for _ in range(num_layers - 2):
-            self.lins.append(torch.nn.Linear(hidden_channels, hidden_channels))
-        self.lins.append(torch.nn.Linear(hidden_channels, out_channels))
-
+        self.proj_i = torch.nn.Linear(in_channels, hidden_channels)
+        self.proj_j = torch.nn.Linear(in_channels, hidden_channels)
+        self.bias = torch.nn.Parameter(torch.zeros(1))
         self.dropout = dropout
+        self.amp = amp #bf16 autocast of the training projections, logits are returned in fp32
 
     def reset_parameters(self):
-        for lin in self.lins:
-            lin.reset_parameters()
-
-    def forward(self, x_i, x_j):
-        x = x_i * x_j
-        for lin in self.lins[:-1]:
-            x = lin(x)
-            x = F.relu(x)
-            x = F.dropout(x, p=self.dropout, training=self.training)
-        x = self.lins[-1](x)
-        return torch.sigmoid(x)
+        self.proj_i.reset_parameters()
+        self.proj_j.reset_parameters()
+        torch.nn.init.zeros_(self.bias)
+
+    def autocast(self, x):
+        return torch.autocast(device_type=x.device.type, dtype=torch.bfloat16, enabled=self.amp, cache_enabled=False)
+
+    def project(self, x_i, x_j):
+        a = F.dropout(self.proj_i(x_i), p=self.dropout, training=self.training)
+        b = self.proj_j(x_j)
+        return a, b
+
+    def score_batch(self, x_i, x_j):
+        r"""
+        score every row of x_i against every row of x_j, (..., B, D) x (..., B_n, D) -> (..., B, B_n)
+        """
+        with self.autocast(x_i):
+            a, b = self.project(x_i, x_j)
+            x = a @ b.transpose(-2, -1) + self.bias
+        return x.float()
+
+    def project_nodes(self, h):
+        r"""
+        project every node embedding once in both roles, so that scoring a snapshot
+        only gathers projected rows, (N, D) -> (N, D'), (N, D')
+        NOTE: the evaluation path stays in fp32 even with amp, bf16 scores would tie and shift the MRR
+        """
+        return self.project(h, h)
+
+    def score_projected(self, h_src_proj, h_dst_proj, query_src, query_dst, block_elems=2**24):
+        r"""
+        score every query source against its candidates from the projected node tables,
+        (P,) x (P, K+1) -> (P, K+1), each block of positives is scored against the whole
+        (N, D') destination table with one matmul and its K+1 candidates are gathered from
+        the (block, N) scores, so no (P, K+1, D') candidate rows are materialized,
+        blocks are sized so that the scores never exceed `block_elems` elements
+        """
+        y_pred = torch.empty(query_dst.shape, dtype=h_src_proj.dtype, device=h_src_proj.device)
+        block_size = max(1, block_elems // h_dst_proj.size(0))
+        for start in range(0, query_dst.size(0), block_size):
+            end = start + block_size
+            y_pred[start:end] = (h_src_proj[query_src[start:end]] @ h_dst_proj.T).gather(1, query_dst[start:end])
+        return y_pred + self.bias
+
+
+class ChunkLoss(torch.nn.Module):
+    r"""
+    masked BCE over chunks of positive edges scored against their shared candidates
+    """
+    def __init__(self, link_pred, chunk_size, num_neg):
+        super(ChunkLoss, self).__init__()
+        self.link_pred = link_pred
+        self.criterion = torch.nn.BCEWithLogitsLoss(reduction='none')
+
+        #* every chunk has the same layout, build its target (positives on the diagonal) once
+        chunk_target = torch.eye(chunk_size, chunk_size + num_neg)
+        self.register_buffer('chunk_target', chunk_target)
+        self.register_buffer('chunk_pos', chunk_target.bool())
+        self.register_buffer('chunk_neg', ~chunk_target.bool())
+
+    def forward(self, src_emb, cand_emb, chunk_mask):
+        r"""
+        src_emb: (B, C, D) source embeddings of each chunk
+        cand_emb: (B, C+K, D) candidate embeddings of each chunk
+        chunk_mask: (B, C, C+K) from `chunk_link_candidates`
+        """
+        out = self.link_pred.score_batch(src_emb, cand_emb)
+        pos_mask = chunk_mask & self.chunk_pos
+        neg_mask = chunk_mask & self.chunk_neg
+        loss_mat = self.criterion(out, self.chunk_target.expand_as(out))
+        loss = (loss_mat * pos_mask).sum() / pos_mask.sum()
+        loss = loss + (loss_mat * neg_mask).sum() / neg_mask.sum()
+        return loss
 
 
 
 
 if __name__ == '__main__':
     from utils.configs import args
-    from utils.utils_func import set_random
-    from utils.data_util import loader
+    from utils.utils_func import set_random, prefetch_neg_batches, chunk_link_candidates, query_mrr
+    from utils.data_util import loader, gcn_norm_csr
 
     set_random(args.seed)
     data = loader(dataset=args.dataset, time_scale=args.time_scale)
@@ -76,8 +170,9 @@ if __name__ == '__main__':
     #! add support for node features in the future
     #node_feat_dim = 16 #all 0s for now
     node_feat_dim = 256 #for node features
-    edge_feat_dim = 1 #for edge weights
     hidden_dim = 256
+    chunk_size = 50 #positive edges sharing one set of candidates
+    num_neg = 50 #sampled negative destinations per chunk
 
     train_data = data['train_data']
     val_data = data['val_data']
@@ -85,6 +180,39 @@ if __name__ == '__main__':
     num_nodes = data['train_data']['num_nodes'] + 1
     num_epochs = args.max_epoch
     lr = args.lr
+    neg_executor = ThreadPoolExecutor(max_workers=2) #queries the evaluation negatives in the background
+
+    #* the evaluation negatives are fixed, load them once for all runs and epochs
+    metric = "mrr"
+    neg_sampler = NegativeEdgeSampler(dataset_name=args.dataset, strategy="hist_rnd")
+    neg_sampler.load_eval_set(fname=args.dataset + "_val_ns.pkl", split_mode="val")
+    neg_sampler.load_eval_set(fname=args.dataset + "_test_ns.pkl", split_mode="test")
+
+    #* the normalized adjacency of every snapshot is built once and reused by all epochs,
+    #* it has E + N nonzeros because of the self loops, so the T snapshots are cached on the host
+    #* and only the one in use is copied to the device, O(E + N) instead of O(T * N) device memory
+    for split_data in (train_data, val_data, test_data):
+        split_data['adj'] = {ts: gcn_norm_csr(edge_index.long(), num_nodes) for ts, edge_index in split_data['edge_index'].items()}
+
+    #* the train snapshots give the chunk candidates every epoch, move them to the device once,
+    #* val/test only propagate the cached adjacency so their edge_index stays on the host
+    train_data['edge_index'] = {ts: edge_index.long().to(args.device) for ts, edge_index in train_data['edge_index'].items()}
+    #* device copies of the original val/test edges, the numpy arrays are kept to query the negative sampler
+    for split_data in (val_data, test_data):
+        split_data['original_index'] = {ts: torch.from_numpy(edges).long().to(args.device) for ts, edges in split_data['original_edges'].items()}
+        #* one reciprocal rank per positive edge, written into a preallocated device buffer during evaluation
+        split_data['mrr_buf'] = torch.empty(sum(edges.shape[1] for edges in split_data['original_edges'].values()), device=args.device)
+
+    #* mixed precision, bf16 autocast for the encoder and link predictor and TF32 for the remaining fp32 matmuls
+    use_amp = args.amp and args.device.type == 'cuda'
+    if (args.amp and not use_amp):
+        print("INFO: --amp needs a cuda device, running in fp32")
+    if (use_amp):
+        torch.set_float32_matmul_precision('high')
+
+    #* torch.compile the loss head only, sparse CSR tensors cannot be traced so the encoder stays eager
+    if (args.compile):
+        torch.set_float32_matmul_precision('high') #TF32 for the 256-dim matmuls
 
 
     for seed in range(args.seed, args.seed + args.num_runs):
@@ -92,16 +220,17 @@ if __name__ == '__main__':
         print (f"Run {seed}")
         
         #* initialization of the model to prep for training
-        model = RecurrentGCN(node_feat_dim=node_feat_dim, hidden_dim=hidden_dim).to(args.device)
-        node_feat = torch.randn((num_nodes, node_feat_dim)).to(args.device)
+        model = RecurrentGCN(node_feat_dim=node_feat_dim, hidden_dim=hidden_dim, num_nodes=num_nodes, amp=use_amp).to(args.device)
 
-        link_pred = LinkPredictor(hidden_dim, hidden_dim, 1,
-                                2, 0.2).to(args.device)
+        link_pred = LinkPredictor(hidden_dim, hidden_dim, 0.2, amp=use_amp).to(args.device)
 
 
         optimizer = torch.optim.Adam(
             set(model.parameters()) | set(link_pred.parameters()), lr=lr)
-        criterion = torch.nn.MSELoss()
+        chunk_loss = ChunkLoss(link_pred, chunk_size, num_neg).to(args.device)
+        if (args.compile):
+            #* all losses of an epoch are backpropagated together, so no CUDA graph replay here
+            chunk_loss = torch.compile(chunk_loss, dynamic=False)
 
         best_val = 0
         best_test = 0
@@ -110,47 +239,36 @@ if __name__ == '__main__':
         for epoch in range(num_epochs):
             print ("------------------------------------------")
             train_start_time = timeit.default_timer()
-            optimizer.zero_grad()
+            optimizer.zero_grad(set_to_none=True)
             total_loss = 0
             model.train()
             link_pred.train()
             snapshot_list = train_data['edge_index']
+            adj_list = train_data['adj']
             h = None 
             for snapshot_idx in range(train_data['time_length']):
                 # neg_edges = negative_sampling(pos_index, num_nodes=num_nodes, num_neg_samples=(pos_index.size(1)*1), force_undirected = True)
                 if (snapshot_idx == 0): #first snapshot, feed the current snapshot
-                    cur_index = snapshot_list[snapshot_idx]
-                    cur_index = cur_index.long().to(args.device)
                     # TODO, also need to support edge attributes correctly in TGX
                     if ('edge_attr' not in train_data):
-                        edge_attr = torch.ones(cur_index.size(1), edge_feat_dim).to(args.device)
+                        cur_adj = adj_list[snapshot_idx].to(args.device)
                     else:
                         raise NotImplementedError("Edge attributes are not yet supported")
-                    h = model(node_feat, cur_index, edge_attr)
+                    h = model(cur_adj)
                 else: #subsequent snapshot, feed the previous snapshot
-                    prev_index = snapshot_list[snapshot_idx-1]
-                    prev_index = prev_index.long().to(args.device)
                     if ('edge_attr' not in train_data):
-                        edge_attr = torch.ones(prev_index.size(1), edge_feat_dim).to(args.device)
+                        prev_adj = adj_list[snapshot_idx-1].to(args.device)
                     else:
                         raise NotImplementedError("Edge attributes are not yet supported")
-                    h = model(node_feat, prev_index, edge_attr)
+                    h = model(prev_adj)
 
                 pos_index = snapshot_list[snapshot_idx]
-                pos_index = pos_index.long().to(args.device)
-
-                neg_dst = torch.randint(
-                        0,
-                        num_nodes,
-                        (pos_index.shape[1],),
-                        dtype=torch.long,
-                        device=args.device,
-                    )
-                pos_out = link_pred(h[pos_index[0]], h[pos_index[1]])
-                neg_out = link_pred(h[pos_index[0]], h[neg_dst])
 
-                total_loss += criterion(pos_out, torch.ones_like(pos_out))
-                total_loss += criterion(neg_out, torch.zeros_like(neg_out))
+                #* every positive is scored against all C+K candidates of its chunk, (B, C, C+K)
+                chunk_src, chunk_cand, chunk_mask = chunk_link_candidates(pos_index, num_nodes, chunk_size, num_neg, pow2_chunks=args.compile)
+                #* one gather for sources and candidates, (B, C + C+K, D)
+                chunk_emb = h[torch.cat([chunk_src, chunk_cand], dim=1)]
+                total_loss += chunk_loss(chunk_emb[:, :chunk_size], chunk_emb[:, chunk_size:], chunk_mask)
 
             total_loss.backward()
             optimizer.step()
@@ -162,63 +280,41 @@ if __name__ == '__main__':
             val_start_time = timeit.default_timer()
             model.eval()
             link_pred.eval()
-            evaluator = Evaluator(name="tgbl-wiki") #reuse MRR evaluator from TGB
-            metric = "mrr"
-            neg_sampler = NegativeEdgeSampler(dataset_name=args.dataset, strategy="hist_rnd")
-
-            #* load the val negative samples
-            neg_sampler.load_eval_set(fname=args.dataset + "_val_ns.pkl", split_mode="val")
-
-            val_snapshots = val_data['edge_index'] #converted to undirected, also removes self loops as required by HTGN
+            val_snapshots = val_data['adj'] #normalized adjacency of the undirected snapshots, cached on the host
             val_edges = val_data['original_edges'] #original edges unmodified
+            val_index = val_data['original_index']
             ts_min = min(val_snapshots.keys())
-            perf_list = {}
-            perf_idx = 0
+            mrr_buf = val_data['mrr_buf']
+            mrr_off = 0
+            neg_batches = prefetch_neg_batches(neg_executor, neg_sampler, val_edges, 'val', val_snapshots.keys(), pin_memory=args.device.type == 'cuda')
 
             h = h.detach()
 
             for snapshot_idx in val_snapshots.keys():
-                pos_index = torch.from_numpy(val_edges[snapshot_idx]) # (2,-1)
-                pos_index = pos_index.long().to(args.device)
-                
-                for i in range(pos_index.shape[1]):
-                    pos_src = pos_index[0][i].item()
-                    pos_dst = pos_index[1][i].item()
-                    pos_t = snapshot_idx
-                    neg_batch_list = neg_sampler.query_batch(np.array([pos_src]), np.array([pos_dst]), np.array([pos_t]), split_mode='val')
-                    
-                    for idx, neg_batch in enumerate(neg_batch_list):
-                        query_src = np.array([int(pos_src) for _ in range(len(neg_batch) + 1)])
-                        query_dst = np.concatenate([np.array([int(pos_dst)]), neg_batch])
-                        query_src = torch.from_numpy(query_src).long().to(args.device)
-                        query_dst = torch.from_numpy(query_dst).long().to(args.device)
-                        edge_index = torch.stack((query_src, query_dst), dim=0)
-                        y_pred = link_pred(h[edge_index[0]], h[edge_index[1]])
-                        y_pred = y_pred.reshape(-1)
-                        y_pred = y_pred.detach().cpu().numpy()
-
-                        input_dict = {
-                                "y_pred_pos": np.array([y_pred[0]]),
-                                "y_pred_neg": y_pred[1:],
-                                "eval_metric": [metric],
-                            }
-                        perf_list[perf_idx] = evaluator.eval(input_dict)[metric]
-                        perf_idx += 1
+                #* negatives of all positive edges in the snapshot, queried in the background
+                query_dst, query_mask = next(neg_batches)
+                query_src = val_index[snapshot_idx][0]
+                query_dst = query_dst.to(args.device, non_blocking=True)
+                query_mask = query_mask.to(args.device, non_blocking=True)
+
+                #* score every positive against its K negatives, in blocks of positives to bound memory
+                with torch.no_grad():
+                    #* project every node once, each query is then a dot product with its K+1 candidates
+                    h_src_proj, h_dst_proj = link_pred.project_nodes(h)
+                    y_pred = link_pred.score_projected(h_src_proj, h_dst_proj, query_src, query_dst)
+                #* rank every positive against its negatives on the device, read back once per split
+                mrr_buf[mrr_off:mrr_off + y_pred.size(0)] = query_mrr(y_pred, query_mask)
+                mrr_off += y_pred.size(0)
 
 
                 #* update the snapshot embedding
-                prev_index = val_snapshots[snapshot_idx]
-                prev_index = prev_index.long().to(args.device)
                 if ('edge_attr' not in val_data):
-                    edge_attr = torch.ones(prev_index.size(1), edge_feat_dim).to(args.device)
+                    prev_adj = val_data['adj'][snapshot_idx].to(args.device)
                 else:
                     raise NotImplementedError("Edge attributes are not yet supported")
-                h = model(node_feat, prev_index, edge_attr).detach()
-
+                h = model(prev_adj).detach()
 
-            result = list(perf_list.values())
-            perf_list = np.array(result)
-            val_metrics = float(np.mean(perf_list))
+            val_metrics = mrr_buf[:mrr_off].mean().item()
             val_time = timeit.default_timer() - val_start_time
 
             print(f"Val {metric}: {val_metrics}")
@@ -233,61 +329,41 @@ if __name__ == '__main__':
             #! report test results when validation improves
             if (val_metrics > best_val):
                 best_val = val_metrics
-                neg_sampler.load_eval_set(fname=args.dataset + "_test_ns.pkl", split_mode="test",)
 
                 test_start_time = timeit.default_timer()
 
-                #* load the test negative samples
-                neg_sampler.load_eval_set(fname=args.dataset + "_test_ns.pkl", split_mode="test")
-
-                test_snapshots = test_data['edge_index'] #converted to undirected, also removes self loops as required by HTGN
+                test_snapshots = test_data['adj'] #normalized adjacency of the undirected snapshots, cached on the host
                 test_edges = test_data['original_edges'] #original edges unmodified
+                test_index = test_data['original_index']
                 ts_min = min(test_snapshots.keys())
                 h = h.detach()
 
-                perf_list = {}
-                perf_idx = 0
+                mrr_buf = test_data['mrr_buf']
+                mrr_off = 0
+                neg_batches = prefetch_neg_batches(neg_executor, neg_sampler, test_edges, 'test', test_snapshots.keys(), pin_memory=args.device.type == 'cuda')
 
                 for snapshot_idx in test_snapshots.keys():
-                    pos_index = torch.from_numpy(test_edges[snapshot_idx])
-                    pos_index = pos_index.long().to(args.device)
-                    
-                    for i in range(pos_index.shape[1]):
-                        pos_src = pos_index[0][i].item()
-                        pos_dst = pos_index[1][i].item()
-                        pos_t = snapshot_idx
-                        neg_batch_list = neg_sampler.query_batch(np.array([pos_src]), np.array([pos_dst]), np.array([pos_t]), split_mode='test')
-                        
-                        for idx, neg_batch in enumerate(neg_batch_list):
-                            query_src = np.array([int(pos_src) for _ in range(len(neg_batch) + 1)])
-                            query_dst = np.concatenate([np.array([int(pos_dst)]), neg_batch])
-                            query_src = torch.from_numpy(query_src).long().to(args.device)
-                            query_dst = torch.from_numpy(query_dst).long().to(args.device)
-                            edge_index = torch.stack((query_src, query_dst), dim=0)
-                            y_pred = link_pred(h[edge_index[0]], h[edge_index[1]])
-                            y_pred = y_pred.reshape(-1)
-                            y_pred = y_pred.detach().cpu().numpy()
-
-                            input_dict = {
-                                    "y_pred_pos": np.array([y_pred[0]]),
-                                    "y_pred_neg": y_pred[1:],
-                                    "eval_metric": [metric],
-                                }
-                            perf_list[perf_idx] = evaluator.eval(input_dict)[metric]
-                            perf_idx += 1
+                    query_dst, query_mask = next(neg_batches)
+                    query_src = test_index[snapshot_idx][0]
+                    query_dst = query_dst.to(args.device, non_blocking=True)
+                    query_mask = query_mask.to(args.device, non_blocking=True)
+
+                    with torch.no_grad():
+                        #* project every node once, each query is then a dot product with its K+1 candidates
+                        h_src_proj, h_dst_proj = link_pred.project_nodes(h)
+                        y_pred = link_pred.score_projected(h_src_proj, h_dst_proj, query_src, query_dst)
+                    #* rank every positive against its negatives on the device, read back once per split
+                    mrr_buf[mrr_off:mrr_off + y_pred.size(0)] = query_mrr(y_pred, query_mask)
+                    mrr_off += y_pred.size(0)
 
                     #* update the snapshot embedding
-                    prev_index = test_snapshots[snapshot_idx]
-                    prev_index = prev_index.long().to(args.device)
                     if ('edge_attr' not in test_data):
-                        edge_attr = torch.ones(prev_index.size(1), edge_feat_dim).to(args.device)
+                        prev_adj = test_data['adj'][snapshot_idx].to(args.device)
                     else:
                         raise NotImplementedError("Edge attributes are not yet supported")
-                    h = model(node_feat, prev_index, edge_attr)
+                    h = model(prev_adj)
 
-                result = list(perf_list.values())
-                perf_list = np.array(result)
-                test_metrics = float(np.mean(perf_list))
+                test_metrics = mrr_buf[:mrr_off].mean().item()
                 test_time = timeit.default_timer() - test_start_time
                 print(f"Test {metric}: {test_metrics}")
                 print ("Test time: ", test_time)
@@ -314,6 +390,9 @@ if __name__ == '__main__':
         print ("best test performance is, ", best_test)
         print ("------------------------------------------")
 
+    #* stop the negative query workers, cancelling queries left behind when a run stops early
+    neg_executor.shutdown(cancel_futures=True)
+
 
 
 
@@ -1,70 +1,135 @@
 import torch
-import numpy as np
 import torch.nn.functional as F
 from torch_geometric_temporal.nn.recurrent import GCLSTM 
 from torch_geometric.utils.negative_sampling import negative_sampling
 # from models.tgn.decoder import LinkPredictor
-from tgb.linkproppred.evaluate import Evaluator
 from tgb.linkproppred.negative_sampler import NegativeEdgeSampler
 import wandb
 import timeit
+from concurrent.futures import ThreadPoolExecutor
 
 
 
 class RecurrentGCN(torch.nn.Module):
-    def __init__(self, node_feat_dim, hidden_dim, K=1):
+    def __init__(self, node_feat_dim, hidden_dim, num_nodes, K=1):
         #https://pytorch-geometric-temporal.readthedocs.io/en/latest/modules/root.html#recurrent-graph-convolutional-layers
         super(RecurrentGCN, self).__init__()
         self.recurrent = GCLSTM(in_channels=node_feat_dim, 
                                 out_channels=hidden_dim, 
                                 K=K,) #K is the Chebyshev filter size
         self.linear = torch.nn.Linear(hidden_dim, hidden_dim)
+        #* fixed random node features, a buffer so they move with the model and keep a stable address
+        self.register_buffer('node_feat', torch.randn((num_nodes, node_feat_dim)))
 
-    def forward(self, x, edge_index, edge_weight, h, c):
+    def forward(self, edge_index, edge_weight, h, c):
         r"""
         forward function for the model, 
         this is used for each snapshot
         h: node hidden state matrix from previous time
         c: cell state matrix from previous time
         """
-        h_0, c_0 = self.recurrent(x, edge_index, edge_weight, h, c)
+        h_0, c_0 = self.recurrent(self.node_feat, edge_index, edge_weight, h, c)
         h = F.relu(h_0)
         h = self.linear(h)
         return h, h_0, c_0
 
 
 class LinkPredictor(torch.nn.Module):
-    def __init__(self, in_channels, hidden_channels, out_channels, num_layers,
-                 dropout):
+    r"""
+    factorized bilinear link predictor, logit(i, j) = <W_i x_i, W_j x_j> + b
+    the two projections are independent so that a batch of sources can be scored
+    against a batch of candidates with one matrix multiplication
+    """
+    def __init__(self, in_channels, hidden_channels, dropout, amp=False):
         super(LinkPredictor, self).__init__()
-
-        self.lins = torch.nn.ModuleList()
-        self.lins.append(torch.nn.Linear(in_channels, hidden_channels))
-        for _ in range(num_layers - 2):
-            self.lins.append(torch.nn.Linear(hidden_channels, hidden_channels))
-        self.lins.append(torch.nn.Linear(hidden_channels, out_channels))
-
+        self.proj_i = torch.nn.Linear(in_channels, hidden_channels)
+        self.proj_j = torch.nn.Linear(in_channels, hidden_channels)
+        self.bias = torch.nn.Parameter(torch.zeros(1))
         self.dropout = dropout
+        self.amp = amp #bf16 autocast of the training projections, logits are returned in fp32
 
     def reset_parameters(self):
-        for lin in self.lins:
-            lin.reset_parameters()
+        self.proj_i.reset_parameters()
+        self.proj_j.reset_parameters()
+        torch.nn.init.zeros_(self.bias)
+
+    def autocast(self, x):
+        return torch.autocast(device_type=x.device.type, dtype=torch.bfloat16, enabled=self.amp, cache_enabled=False)
+
+    def project(self, x_i, x_j):
+        a = F.dropout(self.proj_i(x_i), p=self.dropout, training=self.training)
+        b = self.proj_j(x_j)
+        return a, b
+
+    def score_batch(self, x_i, x_j):
+        r"""
+        score every row of x_i against every row of x_j, (..., B, D) x (..., B_n, D) -> (..., B, B_n)
+        """
+        with self.autocast(x_i):
+            a, b = self.project(x_i, x_j)
+            x = a @ b.transpose(-2, -1) + self.bias
+        return x.float()
 
-    def forward(self, x_i, x_j):
-        x = x_i * x_j
-        for lin in self.lins[:-1]:
-            x = lin(x)
-            x = F.relu(x)
-            x = F.dropout(x, p=self.dropout, training=self.training)
-        x = self.lins[-1](x)
-        return torch.sigmoid(x)
+    def project_nodes(self, h):
+        r"""
+        project every node embedding once in both roles, so that scoring a snapshot
+        only gathers projected rows, (N, D) -> (N, D'), (N, D')
+        NOTE: the evaluation path stays in fp32 even with amp, bf16 scores would tie and shift the MRR
+        """
+        return self.project(h, h)
+
+    def score_projected(self, h_src_proj, h_dst_proj, query_src, query_dst, block_elems=2**24):
+        r"""
+        score every query source against its candidates from the projected node tables,
+        (P,) x (P, K+1) -> (P, K+1), each block of positives is scored against the whole
+        (N, D') destination table with one matmul and its K+1 candidates are gathered from
+        the (block, N) scores, so no (P, K+1, D') candidate rows are materialized,
+        blocks are sized so that the scores never exceed `block_elems` elements
+        """
+        y_pred = torch.empty(query_dst.shape, dtype=h_src_proj.dtype, device=h_src_proj.device)
+        block_size = max(1, block_elems // h_dst_proj.size(0))
+        for start in range(0, query_dst.size(0), block_size):
+            end = start + block_size
+            y_pred[start:end] = (h_src_proj[query_src[start:end]] @ h_dst_proj.T).gather(1, query_dst[start:end])
+        return y_pred + self.bias
+
+
+class ChunkLoss(torch.nn.Module):
+    r"""
+    masked BCE over chunks of positive edges scored against their shared candidates,
+    a module of its own so that it can be captured as a CUDA graph per chunk count
+    """
+    def __init__(self, link_pred, chunk_size, num_neg):
+        super(ChunkLoss, self).__init__()
+        self.link_pred = link_pred
+        self.criterion = torch.nn.BCEWithLogitsLoss(reduction='none')
+
+        #* every chunk has the same layout, build its target (positives on the diagonal) once
+        chunk_target = torch.eye(chunk_size, chunk_size + num_neg)
+        self.register_buffer('chunk_target', chunk_target)
+        self.register_buffer('chunk_pos', chunk_target.bool())
+        self.register_buffer('chunk_neg', ~chunk_target.bool())
+
+    def forward(self, src_emb, cand_emb, chunk_mask):
+        r"""
+        src_emb: (B, C, D) source embeddings of each chunk
+        cand_emb: (B, C+K, D) candidate embeddings of each chunk
+        chunk_mask: (B, C, C+K) from `chunk_link_candidates`
+        """
+        out = self.link_pred.score_batch(src_emb, cand_emb)
+        pos_mask = chunk_mask & self.chunk_pos
+        neg_mask = chunk_mask & self.chunk_neg
+        loss_mat = self.criterion(out, self.chunk_target.expand_as(out))
+        loss = (loss_mat * pos_mask).sum() / pos_mask.sum()
+        loss = loss + (loss_mat * neg_mask).sum() / neg_mask.sum()
+        return loss
 
 
 
 
 if __name__ == '__main__':
     from utils.configs import args
-    from utils.utils_func import set_random
+    from utils.utils_func import set_random, prefetch_neg_batches, chunk_link_candidates, query_mrr
     from utils.data_util import loader
 
     set_random(args.seed)
@@ -88,6 +153,8 @@ if __name__ == '__main__':
     node_feat_dim = 256 #for node features
     edge_feat_dim = 1 #for edge weights
     hidden_dim = 256
+    chunk_size = 50 #positive edges sharing one set of candidates
+    num_neg = 50 #sampled negative destinations per chunk
 
     train_data = data['train_data']
     val_data = data['val_data']
@@ -95,6 +162,57 @@ if __name__ == '__main__':
     num_nodes = data['train_data']['num_nodes'] + 1
     num_epochs = args.max_epoch
     lr = args.lr
+    neg_executor = ThreadPoolExecutor(max_workers=2) #queries the evaluation negatives in the background
+
+    #* the evaluation negatives are fixed, load them once for all runs and epochs
+    metric = "mrr"
+    neg_sampler = NegativeEdgeSampler(dataset_name=args.dataset, strategy="hist_rnd")
+    neg_sampler.load_eval_set(fname=args.dataset + "_val_ns.pkl", split_mode="val")
+    neg_sampler.load_eval_set(fname=args.dataset + "_test_ns.pkl", split_mode="test")
+
+    #* the snapshots are reused every epoch, move them to the device once
+    for split_data in (train_data, val_data, test_data):
+        split_data['edge_index'] = {ts: edge_index.long().to(args.device) for ts, edge_index in split_data['edge_index'].items()}
+    #* device copies of the original val/test edges, the numpy arrays are kept to query the negative sampler
+    for split_data in (val_data, test_data):
+        split_data['original_index'] = {ts: torch.from_numpy(edges).long().to(args.device) for ts, edges in split_data['original_edges'].items()}
+        #* one reciprocal rank per positive edge, written into a preallocated device buffer during evaluation
+        split_data['mrr_buf'] = torch.empty(sum(edges.shape[1] for edges in split_data['original_edges'].values()), device=args.device)
+
+    #* all snapshots use unit edge weights, slice them from one buffer instead of allocating per snapshot
+    max_edges = max(edge_index.size(1) for split_data in (train_data, val_data, test_data) for edge_index in split_data['edge_index'].values())
+    edge_attr_buf = torch.ones(max_edges, edge_feat_dim, device=args.device)
+
+    #* a captured loss can only be replayed if each forward is followed by its backward
+    use_cuda_graph = args.cuda_graph and args.device.type == 'cuda' and args.tbptt_len == 1
+    if (args.cuda_graph and not use_cuda_graph):
+        print("INFO: CUDA graph capture needs a cuda device and --tbptt_len 1, running eagerly")
+
+    #* torch.compile, the loss head has a static shape per power of two chunk count
+    use_compile = args.compile and not use_cuda_graph
+    if (args.compile and use_cuda_graph):
+        print("INFO: --compile and --cuda_graph both capture the loss head, using CUDA graphs")
+    if (use_compile):
+        torch.set_float32_matmul_precision('high') #TF32 for the 256-dim matmuls
+        #* outputs of a replayed graph are overwritten by the next replay, only safe when every loss is backpropagated right away
+        compile_mode = 'reduce-overhead' if (args.tbptt_len == 1) else 'default'
+        #* the encoder sees one shape per snapshot edge count (plus the first call without a recurrent state),
+        #* padding cannot fix this since GCLSTM drops and re-adds self loops, so fall back to eager when it would keep recompiling
+        #* dynamo also guards on the training flag, train snapshots are compiled in train mode and val/test snapshots in eval mode
+        num_train_shapes = len({edge_index.size(1) for edge_index in train_data['edge_index'].values()}) + 1
+        num_eval_shapes = len({edge_index.size(1) for split_data in (val_data, test_data) for edge_index in split_data['edge_index'].values()})
+        num_shapes = num_train_shapes + num_eval_shapes
+        compile_encoder = num_shapes <= torch._dynamo.config.cache_size_limit
+        if (not compile_encoder):
+            print(f"INFO: {num_shapes} snapshot shapes exceed the recompile limit, running the encoder eagerly")
+
+
+    #* mixed precision, bf16 autocast for the link predictor, GCLSTM stays in fp32 with TF32 matmuls
+    use_amp = args.amp and args.device.type == 'cuda'
+    if (args.amp and not use_amp):
+        print("INFO: --amp needs a cuda device, running in fp32")
+    if (use_amp):
+        torch.set_float32_matmul_precision('high')
 
 
     for seed in range(args.seed, args.seed + args.num_runs):
@@ -102,19 +220,21 @@ if __name__ == '__main__':
         print (f"Run {seed}")
         
         #* initialization of the model to prep for training
-        model = RecurrentGCN(node_feat_dim=node_feat_dim, hidden_dim=hidden_dim, K=1).to(args.device)
-        # node_feat = torch.zeros((num_nodes, node_feat_dim)).to(args.device)
-        node_feat = torch.randn((num_nodes, node_feat_dim)).to(args.device)
+        model = RecurrentGCN(node_feat_dim=node_feat_dim, hidden_dim=hidden_dim, num_nodes=num_nodes, K=1).to(args.device)
 
         # link_pred = LinkPredictor(in_channels=hidden_dim).to(args.device)
-        link_pred = LinkPredictor(hidden_dim, hidden_dim, 1,
-                                2, 0.2).to(args.device)
+        link_pred = LinkPredictor(hidden_dim, hidden_dim, 0.2, amp=use_amp).to(args.device)
 
 
         optimizer = torch.optim.Adam(
             set(model.parameters()) | set(link_pred.parameters()), lr=lr)
         # criterion = torch.nn.BCEWithLogitsLoss()
-        criterion = torch.nn.MSELoss()
+        chunk_loss = ChunkLoss(link_pred, chunk_size, num_neg).to(args.device)
+        graphed_loss = {} #captured chunk losses keyed by number of chunks
+        if (use_compile):
+            chunk_loss = torch.compile(chunk_loss, mode=compile_mode, dynamic=False)
+            if (compile_encoder):
+                model = torch.compile(model, dynamic=False)
 
         best_val = 0
         best_test = 0
@@ -123,66 +243,67 @@ if __name__ == '__main__':
         for epoch in range(num_epochs):
             print ("------------------------------------------")
             train_start_time = timeit.default_timer()
-            optimizer.zero_grad()
+            optimizer.zero_grad(set_to_none=True)
             total_loss = 0
             model.train()
             link_pred.train()
             snapshot_list = train_data['edge_index']
             h_0, c_0, h = None, None, None
             total_loss = 0
+            local_loss = 0
             for snapshot_idx in range(train_data['time_length']):
 
-                optimizer.zero_grad()
                 # neg_edges = negative_sampling(pos_index, num_nodes=num_nodes, num_neg_samples=(pos_index.size(1)*1), force_undirected = True)
                 if (snapshot_idx == 0): #first snapshot, feed the current snapshot
                     cur_index = snapshot_list[snapshot_idx]
-                    cur_index = cur_index.long().to(args.device)
                     # TODO, also need to support edge attributes correctly in TGX
                     if ('edge_attr' not in train_data):
-                        edge_attr = torch.ones(cur_index.size(1), edge_feat_dim).to(args.device)
+                        edge_attr = edge_attr_buf[:cur_index.size(1)]
                     else:
                         raise NotImplementedError("Edge attributes are not yet supported")
-                    h, h_0, c_0 = model(node_feat, cur_index, edge_attr, h_0, c_0)
+                    h, h_0, c_0 = model(cur_index, edge_attr, h_0, c_0)
                 else: #subsequent snapshot, feed the previous snapshot
                     prev_index = snapshot_list[snapshot_idx-1]
-                    prev_index = prev_index.long().to(args.device)
                     if ('edge_attr' not in train_data):
-                        edge_attr = torch.ones(prev_index.size(1), edge_feat_dim).to(args.device)
+                        edge_attr = edge_attr_buf[:prev_index.size(1)]
                     else:
                         raise NotImplementedError("Edge attributes are not yet supported")
-                    h, h_0, c_0 = model(node_feat, prev_index, edge_attr, h_0, c_0)
+                    h, h_0, c_0 = model(prev_index, edge_attr, h_0, c_0)
 
                 pos_index = snapshot_list[snapshot_idx]
-                pos_index = pos_index.long().to(args.device)
 
-                neg_dst = torch.randint(
-                        0,
-                        num_nodes,
-                        (pos_index.shape[1],),
-                        dtype=torch.long,
-                        device=args.device,
-                    )
-
-                pos_out = link_pred(h[pos_index[0]], h[pos_index[1]])
-                # pos_loss = -torch.log(pos_out + 1e-15).mean()
-
-
-                neg_out = link_pred(h[pos_index[0]], h[neg_dst])
-                # neg_loss = -torch.log(1 - neg_out + 1e-15).mean()
-                #loss = pos_loss + neg_loss
-
-                loss = criterion(pos_out, torch.ones_like(pos_out))
-                loss += criterion(neg_out, torch.zeros_like(neg_out))
-
-                loss.backward()
-                optimizer.step()
+                #* every positive is scored against all C+K candidates of its chunk, (B, C, C+K)
+                chunk_src, chunk_cand, chunk_mask = chunk_link_candidates(pos_index, num_nodes, chunk_size, num_neg, pow2_chunks=use_cuda_graph or use_compile)
+                #* one gather for sources and candidates, (B, C + C+K, D)
+                chunk_emb = h[torch.cat([chunk_src, chunk_cand], dim=1)]
+                loss_args = (chunk_emb[:, :chunk_size], chunk_emb[:, chunk_size:], chunk_mask)
+
+                if (use_cuda_graph):
+                    #* capture the loss forward/backward once per (power of two) chunk count and replay it
+                    num_chunks = chunk_src.size(0)
+                    if (num_chunks not in graphed_loss):
+                        sample_args = tuple(arg.detach().clone().requires_grad_(arg.requires_grad) for arg in loss_args)
+                        graphed_loss[num_chunks] = torch.cuda.make_graphed_callables(
+                            ChunkLoss(link_pred, chunk_size, num_neg).to(args.device), sample_args)
+                    loss = graphed_loss[num_chunks](*loss_args)
+                else:
+                    loss = chunk_loss(*loss_args)
 
-                total_loss += (float(loss) / pos_index.shape[1])
+                local_loss += loss
+                #* accumulate on the device, the graphed loss output is read back once per epoch
+                total_loss += loss.detach() / pos_index.shape[1]
 
+                #* truncated BPTT, backpropagate every tbptt_len snapshots and cut the recurrent state
+                if ((snapshot_idx + 1) % args.tbptt_len == 0 or snapshot_idx == train_data['time_length'] - 1):
+                    local_loss.backward()
+                    optimizer.step()
+                    optimizer.zero_grad(set_to_none=True)
+                    local_loss = 0
 
-                h_0 = h_0.detach()
-                c_0 = c_0.detach()
+                    h_0 = h_0.detach()
+                    c_0 = c_0.detach()
 
+            total_loss = float(total_loss)
             print (f'Epoch {epoch}/{num_epochs}, Loss: {total_loss}')
 
             train_time = timeit.default_timer() - train_start_time
@@ -192,66 +313,45 @@ if __name__ == '__main__':
             val_start_time = timeit.default_timer()
             model.eval()
             link_pred.eval()
-            evaluator = Evaluator(name="tgbl-wiki") #reuse MRR evaluator from TGB
-            metric = "mrr"
-            neg_sampler = NegativeEdgeSampler(dataset_name=args.dataset, strategy="hist_rnd")
-
-            #* load the val negative samples
-            neg_sampler.load_eval_set(fname=args.dataset + "_val_ns.pkl", split_mode="val")
-
             val_snapshots = val_data['edge_index'] #converted to undirected, also removes self loops as required by HTGN
             val_edges = val_data['original_edges'] #original edges unmodified
+            val_index = val_data['original_index']
             ts_min = min(val_snapshots.keys())
 
             h_0 = h_0.detach()
             c_0 = c_0.detach()
             h = h.detach()
 
-            perf_list = {}
-            perf_idx = 0
+            mrr_buf = val_data['mrr_buf']
+            mrr_off = 0
+            neg_batches = prefetch_neg_batches(neg_executor, neg_sampler, val_edges, 'val', val_snapshots.keys(), pin_memory=args.device.type == 'cuda')
 
             for snapshot_idx in val_snapshots.keys():
-                pos_index = torch.from_numpy(val_edges[snapshot_idx]) # (2,-1)
-                pos_index = pos_index.long().to(args.device)
-                
-                for i in range(pos_index.shape[1]):
-                    pos_src = pos_index[0][i].item()
-                    pos_dst = pos_index[1][i].item()
-                    pos_t = snapshot_idx
-                    neg_batch_list = neg_sampler.query_batch(np.array([pos_src]), np.array([pos_dst]), np.array([pos_t]), split_mode='val')
-                    
-                    for idx, neg_batch in enumerate(neg_batch_list):
-                        query_src = np.array([int(pos_src) for _ in range(len(neg_batch) + 1)])
-                        query_dst = np.concatenate([np.array([int(pos_dst)]), neg_batch])
-                        query_src = torch.from_numpy(query_src).long().to(args.device)
-                        query_dst = torch.from_numpy(query_dst).long().to(args.device)
-                        edge_index = torch.stack((query_src, query_dst), dim=0)
-                        y_pred = link_pred(h[edge_index[0]], h[edge_index[1]])
-                        y_pred = y_pred.reshape(-1)
-                        y_pred = y_pred.detach().cpu().numpy()
-
-                        input_dict = {
-                                "y_pred_pos": np.array([y_pred[0]]),
-                                "y_pred_neg": y_pred[1:],
-                                "eval_metric": [metric],
-                            }
-                        perf_list[perf_idx] = evaluator.eval(input_dict)[metric]
-                        perf_idx += 1
+                #* negatives of all positive edges in the snapshot, queried in the background
+                query_dst, query_mask = next(neg_batches)
+                query_src = val_index[snapshot_idx][0]
+                query_dst = query_dst.to(args.device, non_blocking=True)
+                query_mask = query_mask.to(args.device, non_blocking=True)
+
+                #* score every positive against its K negatives, in blocks of positives to bound memory
+                with torch.no_grad():
+                    #* project every node once, each query is then a dot product with its K+1 candidates
+                    h_src_proj, h_dst_proj = link_pred.project_nodes(h)
+                    y_pred = link_pred.score_projected(h_src_proj, h_dst_proj, query_src, query_dst)
+                #* rank every positive against its negatives on the device, read back once per split
+                mrr_buf[mrr_off:mrr_off + y_pred.size(0)] = query_mrr(y_pred, query_mask)
+                mrr_off += y_pred.size(0)
 
 
                 #* update the snapshot embedding
                 prev_index = val_snapshots[snapshot_idx]
-                prev_index = prev_index.long().to(args.device)
                 if ('edge_attr' not in val_data):
-                    edge_attr = torch.ones(prev_index.size(1), edge_feat_dim).to(args.device)
+                    edge_attr = edge_attr_buf[:prev_index.size(1)]
                 else:
                     raise NotImplementedError("Edge attributes are not yet supported")
-                h, h_0, c_0 = model(node_feat, prev_index, edge_attr, h_0, c_0)
+                h, h_0, c_0 = model(prev_index, edge_attr, h_0, c_0)
 
-
-            result = list(perf_list.values())
-            perf_list = np.array(result)
-            val_metrics = float(np.mean(perf_list))
+            val_metrics = mrr_buf[:mrr_off].mean().item()
             val_time = timeit.default_timer() - val_start_time
 
             print(f"Val {metric}: {val_metrics}")
@@ -266,64 +366,45 @@ if __name__ == '__main__':
             #! report test results when validation improves
             if (val_metrics > best_val):
                 best_val = val_metrics
-                neg_sampler.load_eval_set(fname=args.dataset + "_test_ns.pkl", split_mode="test",)
 
                 test_start_time = timeit.default_timer()
 
-                #* load the test negative samples
-                neg_sampler.load_eval_set(fname=args.dataset + "_test_ns.pkl", split_mode="test")
-
                 test_snapshots = test_data['edge_index'] #converted to undirected, also removes self loops as required by HTGN
                 test_edges = test_data['original_edges'] #original edges unmodified
+                test_index = test_data['original_index']
                 ts_min = min(test_snapshots.keys())
 
                 h_0 = h_0.detach()
                 c_0 = c_0.detach()
                 h = h.detach()
 
-                perf_list = {}
-                perf_idx = 0
+                mrr_buf = test_data['mrr_buf']
+                mrr_off = 0
+                neg_batches = prefetch_neg_batches(neg_executor, neg_sampler, test_edges, 'test', test_snapshots.keys(), pin_memory=args.device.type == 'cuda')
 
                 for snapshot_idx in test_snapshots.keys():
-                    pos_index = torch.from_numpy(test_edges[snapshot_idx])
-                    pos_index = pos_index.long().to(args.device)
-                    
-                    for i in range(pos_index.shape[1]):
-                        pos_src = pos_index[0][i].item()
-                        pos_dst = pos_index[1][i].item()
-                        pos_t = snapshot_idx
-                        neg_batch_list = neg_sampler.query_batch(np.array([pos_src]), np.array([pos_dst]), np.array([pos_t]), split_mode='test')
-                        
-                        for idx, neg_batch in enumerate(neg_batch_list):
-                            query_src = np.array([int(pos_src) for _ in range(len(neg_batch) + 1)])
-                            query_dst = np.concatenate([np.array([int(pos_dst)]), neg_batch])
-                            query_src = torch.from_numpy(query_src).long().to(args.device)
-                            query_dst = torch.from_numpy(query_dst).long().to(args.device)
-                            edge_index = torch.stack((query_src, query_dst), dim=0)
-                            y_pred = link_pred(h[edge_index[0]], h[edge_index[1]])
-                            y_pred = y_pred.reshape(-1)
-                            y_pred = y_pred.detach().cpu().numpy()
-
-                            input_dict = {
-                                    "y_pred_pos": np.array([y_pred[0]]),
-                                    "y_pred_neg": y_pred[1:],
-                                    "eval_metric": [metric],
-                                }
-                            perf_list[perf_idx] = evaluator.eval(input_dict)[metric]
-                            perf_idx += 1
+                    query_dst, query_mask = next(neg_batches)
+                    query_src = test_index[snapshot_idx][0]
+                    query_dst = query_dst.to(args.device, non_blocking=True)
+                    query_mask = query_mask.to(args.device, non_blocking=True)
+
+                    with torch.no_grad():
+                        #* project every node once, each query is then a dot product with its K+1 candidates
+                        h_src_proj, h_dst_proj = link_pred.project_nodes(h)
+                        y_pred = link_pred.score_projected(h_src_proj, h_dst_proj, query_src, query_dst)
+                    #* rank every positive against its negatives on the device, read back once per split
+                    mrr_buf[mrr_off:mrr_off + y_pred.size(0)] = query_mrr(y_pred, query_mask)
+                    mrr_off += y_pred.size(0)
 
                     #* update the snapshot embedding
                     prev_index = test_snapshots[snapshot_idx]
-                    prev_index = prev_index.long().to(args.device)
                     if ('edge_attr' not in test_data):
-                        edge_attr = torch.ones(prev_index.size(1), edge_feat_dim).to(args.device)
+                        edge_attr = edge_attr_buf[:prev_index.size(1)]
                     else:
                         raise NotImplementedError("Edge attributes are not yet supported")
-                    h, h_0, c_0 = model(node_feat, prev_index, edge_attr, h_0, c_0)
+                    h, h_0, c_0 = model(prev_index, edge_attr, h_0, c_0)
 
-                result = list(perf_list.values())
-                perf_list = np.array(result)
-                test_metrics = float(np.mean(perf_list))
+                test_metrics = mrr_buf[:mrr_off].mean().item()
                 test_time = timeit.default_timer() - test_start_time
                 print(f"Test {metric}: {test_metrics}")
                 print ("Test time: ", test_time)
@@ -346,6 +427,9 @@ if __name__ == '__main__':
         print ("best test performance is, ", best_test)
         print ("------------------------------------------")
 
+    #* stop the negative query workers, cancelling queries left behind when a run stops early
+    neg_executor.shutdown(cancel_futures=True)
+
 
 
 
@@ -0,0 +1,178 @@
+import numpy as np
+import torch
+from tgb.linkproppred.evaluate import Evaluator
+#! use assert to ensure https://docs.pytest.org/en/8.0.x/getting-started.html
+
+
+def evaluator_mrr(evaluator, pos_pred, neg_pred) -> float:
+    r"""
+    helper function returning the reciprocal rank of one query from the TGB evaluator
+    """
+    input_dict = {
+            "y_pred_pos": np.array([pos_pred]),
+            "y_pred_neg": np.asarray(neg_pred),
+            "eval_metric": ["mrr"],
+        }
+    return evaluator.eval(input_dict)["mrr"]
+
+
+def test_stack_neg_batch():
+    r"""
+    stack equal length and ragged negative lists, rank them with `query_mrr`
+    and compare every query with the per-query TGB evaluator
+    """
+    from utils.utils_func import stack_neg_batch, query_mrr
+
+    rng = np.random.default_rng(0)
+    num_nodes = 20
+    num_pos = 8
+    evaluator = Evaluator(name="tgbl-wiki")
+
+    #* integer node scores, so that candidates often tie with the positive
+    node_score = rng.integers(0, 5, size=num_nodes).astype(np.float32)
+    pos_dst = rng.integers(0, num_nodes, size=num_pos)
+
+    equal_list = [rng.integers(0, num_nodes, size=6) for _ in range(num_pos)]
+    ragged_list = [rng.integers(0, num_nodes, size=num_neg) for num_neg in (6, 3, 1, 6, 2, 5, 4, 6)]
+
+    for neg_batch_list in (equal_list, ragged_list):
+        query_dst, query_mask = stack_neg_batch(neg_batch_list, pos_dst)
+        assert query_dst.shape == (num_pos, 7), "one column for the positive and one per negative of the longest row"
+        assert (query_dst[:, 0] == pos_dst).all(), "column 0 holds the positive destination"
+        assert query_mask.sum(axis=1).tolist() == [len(neg_batch) + 1 for neg_batch in neg_batch_list], "only padding is masked out"
+
+        y_pred = torch.from_numpy(node_score[query_dst])
+        mrr = query_mrr(y_pred, torch.from_numpy(query_mask))
+        for idx, neg_batch in enumerate(neg_batch_list):
+            ref_mrr = evaluator_mrr(evaluator, node_score[pos_dst[idx]], node_score[neg_batch])
+            assert abs(mrr[idx].item() - ref_mrr) < 1e-6, "reciprocal rank matches the TGB evaluator"
+
+
+def test_query_mrr():
+    r"""
+    compare `query_mrr` with the TGB evaluator on random scores with ties and masked ragged rows
+    """
+    from utils.utils_func import query_mrr
+
+    torch.manual_seed(0)
+    num_pos = 16
+    num_neg = 10
+    evaluator = Evaluator(name="tgbl-wiki")
+
+    #* few distinct score values, so that many negatives tie with the positive
+    y_pred = torch.randint(0, 4, (num_pos, num_neg + 1)).float()
+    #* ragged rows keep a prefix of their negatives, padding values must not affect the rank
+    row_len = torch.randint(1, num_neg + 1, (num_pos,))
+    query_mask = torch.arange(num_neg + 1).unsqueeze(0) <= row_len.unsqueeze(1)
+    y_pred[~query_mask] = 10.0
+
+    mrr = query_mrr(y_pred, query_mask)
+    assert mrr.shape == (num_pos,), "one reciprocal rank per query"
+    for idx in range(num_pos):
+        query_pred = y_pred[idx][query_mask[idx]].numpy()
+        ref_mrr = evaluator_mrr(evaluator, query_pred[0], query_pred[1:])
+        assert abs(mrr[idx].item() - ref_mrr) < 1e-6, "reciprocal rank matches the TGB evaluator"
+
+
+def test_chunk_link_candidates():
+    r"""
+    check the chunk mask on one chunk with duplicate sources, sampled negatives
+    that equal positive destinations, and padded rows and columns
+    """
+    from utils.utils_func import chunk_link_candidates
+
+    torch.manual_seed(0)
+    #* sources 1 and 5 appear twice, the destinations cover every node that can be sampled as a negative
+    pos_index = torch.tensor([[1, 1, 4, 5, 5],
+                              [2, 3, 2, 0, 1]])
+    num_edges = pos_index.size(1)
+    num_nodes = 4
+    chunk_size = 8
+    num_neg = 4
+
+    chunk_src, chunk_cand, chunk_mask = chunk_link_candidates(pos_index, num_nodes, chunk_size, num_neg)
+    assert chunk_src.shape == (1, chunk_size), "one chunk holds all edges"
+    assert chunk_cand.shape == (1, chunk_size + num_neg), "in-batch destinations followed by the negatives"
+    assert chunk_mask.shape == (1, chunk_size, chunk_size + num_neg), "one mask entry per (source, candidate)"
+
+    chunk_src = chunk_src[0]
+    chunk_cand = chunk_cand[0]
+    chunk_mask = chunk_mask[0]
+    chunk_dst = chunk_cand[:chunk_size]
+    chunk_edges = sorted(zip(chunk_src[:num_edges].tolist(), chunk_dst[:num_edges].tolist()))
+    assert chunk_edges == sorted(zip(*pos_index.tolist())), "every positive edge is in the chunk once, before the padding"
+
+    #* padded rows and in-batch columns are never scored
+    assert not chunk_mask[num_edges:].any(), "padded rows are masked"
+    assert not chunk_mask[:, num_edges:chunk_size].any(), "padded candidate columns are masked"
+    #* the positive itself is always scored
+    assert chunk_mask.diagonal()[:num_edges].all(), "the diagonal is kept"
+
+    #* a sampled negative equal to a positive destination is an induced positive of that row
+    neg_cand = chunk_cand[chunk_size:]
+    induced_neg = neg_cand.unsqueeze(0) == chunk_dst[:num_edges].unsqueeze(1)
+    assert induced_neg.any(dim=0).all(), "every negative collides with some positive destination"
+    assert not chunk_mask[:num_edges, chunk_size:][induced_neg].any(), "colliding negatives are masked"
+    assert chunk_mask[:num_edges, chunk_size:][~induced_neg].all(), "other negatives are kept"
+
+    #* an in-batch destination of another edge from the same source is an induced positive
+    src = chunk_src[:num_edges]
+    dst = chunk_dst[:num_edges]
+    off_diag = ~torch.eye(num_edges, dtype=torch.bool)
+    same_src = (src.unsqueeze(1) == src.unsqueeze(0)) & off_diag
+    same_dst = (dst.unsqueeze(1) == dst.unsqueeze(0)) & off_diag
+    assert same_src.any(), "the chunk has duplicate sources"
+    in_batch_mask = chunk_mask[:num_edges, :num_edges]
+    assert not in_batch_mask[same_src | same_dst].any(), "induced in-batch positives are masked"
+    assert in_batch_mask[off_diag & ~same_src & ~same_dst].all(), "other in-batch negatives are kept"
+
+    #* pow2_chunks pads whole chunks, which are masked entirely
+    chunk_src, chunk_cand, chunk_mask = chunk_link_candidates(pos_index, num_nodes, 2, num_neg, pow2_chunks=True)
+    assert chunk_src.size(0) == 4, "3 chunks of 2 edges are padded to 4"
+    assert not chunk_mask[3].any(), "a padding chunk is masked entirely"
+    assert chunk_mask[:3, 0, 0].all(), "the first positive of every chunk holding edges is scored"
+
+
+
+def test_csr_evolvegcno():
+    r"""
+    CSREvolveGCNO on the cached CSR adjacency must match the installed EvolveGCNO
+    propagating the same snapshots with its GCN convolution, forward and backward
+    """
+    from torch_geometric_temporal.nn.recurrent import EvolveGCNO
+    from dtdg_egcno_original import CSREvolveGCNO
+    from utils.data_util import gcn_norm_csr
+
+    torch.manual_seed(0)
+    num_nodes = 12
+    in_channels = 8
+    ref_layer = EvolveGCNO(in_channels)
+    csr_layer = CSREvolveGCNO(in_channels)
+    csr_layer.load_state_dict(ref_layer.state_dict())
+    x = torch.randn(num_nodes, in_channels)
+
+    ref_loss = 0
+    csr_loss = 0
+    for snapshot_idx in range(3):
+        #* random snapshots with duplicate edges and an existing self loop
+        edge_index = torch.randint(0, num_nodes, (2, 30))
+        edge_index[:, 0] = 3
+        ref_out = ref_layer(x, edge_index)
+        csr_out = csr_layer(x, gcn_norm_csr(edge_index, num_nodes))
+        assert torch.allclose(ref_out, csr_out, atol=1e-5), "CSR propagation matches the GCN convolution"
+        ref_loss += ref_out.pow(2).sum()
+        csr_loss += csr_out.pow(2).sum()
+
+    ref_loss.backward()
+    csr_loss.backward()
+    ref_params = dict(ref_layer.named_parameters())
+    for name, param in csr_layer.named_parameters():
+        assert torch.allclose(ref_params[name].grad, param.grad, atol=1e-4), f"gradient of {name} matches"
+
+
+
+if __name__ == '__main__':
+    test_stack_neg_batch()
+    test_query_mrr()
+    test_chunk_link_candidates()
+    test_csr_evolvegcno()
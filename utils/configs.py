@@ -36,6 +36,10 @@ parser.add_argument('--pre_defined_feature', default=None, help='pre-defined nod
 parser.add_argument('--save_embeddings', type=int, default=0, help='save or not, default:0')
 parser.add_argument('--debug_mode', type=int, default=0, help='debug_mode, 0: normal running; 1: debugging mode')
 parser.add_argument('--min_epoch', type=int, default=100, help='min epoch')
+parser.add_argument('--tbptt_len', type=int, default=1, help='snapshots per truncated BPTT window, default: 1')
+parser.add_argument('--cuda_graph', action='store_true', default=False, help='capture the link prediction loss as CUDA graphs')
+parser.add_argument('--compile', action='store_true', default=False, help='compile the link prediction loss (and the encoder when shapes allow) with torch.compile')
+parser.add_argument('--amp', action='store_true', default=False, help='bf16 autocast and TF32 matmuls on cuda devices')
 
 # 3.models
 parser.add_argument('--model', type=str, default='HTGN', help='model name')
@@ -58,6 +62,8 @@ parser.add_argument('--nout', type=int, default=16, help='dim of output embeddin
 parser.add_argument('--roland_update', type=str, default="gru", help="ROLAND update strategy.")
 
 args = parser.parse_args()
+if args.tbptt_len < 1:
+    parser.error('--tbptt_len must be at least 1, got {}'.format(args.tbptt_len))
 
 # set the running device
 if int(args.device_id) >= 0 and torch.cuda.is_available():
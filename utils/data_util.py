@@ -6,6 +6,7 @@ import tgb
 import torch
 from torch_geometric.utils import remove_self_loops
 from torch_geometric.utils.undirected import to_undirected
+from torch_geometric.nn.conv.gcn_conv import gcn_norm
 
 
 def get_edges(edge_index_list: list) -> list:
@@ -39,6 +40,23 @@ def get_edges(edge_index_list: list) -> list:
     return undirected_edge_list
 
 
+def gcn_norm_csr(edge_index, num_nodes: int):
+    r"""
+    build the GCN normalized adjacency D^-1/2 (A + I) D^-1/2 of a snapshot with unit edge weights
+    Parameters:
+        edge_index: (2, E) edge index of the snapshot
+        num_nodes: number of nodes in the graph
+    Output:
+        adj: (num_nodes, num_nodes) sparse CSR tensor, row i aggregates the messages sent to node i
+    NOTE: every node gets a self loop, so adj has E + num_nodes nonzeros regardless of the snapshot size,
+    build it on the host when many snapshots are cached
+    """
+    edge_index, edge_weight = gcn_norm(edge_index, None, num_nodes, add_self_loops=True)
+    # messages flow from source to target, so targets index the rows
+    adj = torch.sparse_coo_tensor(edge_index.flip(0), edge_weight, (num_nodes, num_nodes))
+    return adj.coalesce().to_sparse_csr()
+
+
 def load_dtdg(dataset_name: str,
               time_scale: str,
               verbose: bool = True):
@@ -1,4 +1,5 @@
 import torch
+import torch.nn.functional as F
 from torch_geometric.data import TemporalData
 import random
 import os
@@ -182,3 +183,130 @@ def convert_to_torch_extended(src, dst, ts, lbl, edge_idx):
         edge_idx = edge_idx.long()
 
     return src, dst, ts, lbl, edge_idx
+
+
+def stack_neg_batch(neg_batch_list, pos_dst):
+    r"""
+    stack the negatives returned by `query_batch` into one candidate matrix so
+    that all positives of a snapshot can be scored in a single batch
+    Parameters:
+        neg_batch_list: list of negative destinations, one entry per positive edge
+        pos_dst: numpy array of positive destinations, shape (P,)
+    Returns:
+        query_dst: (P, K+1) array, column 0 is the positive destination
+        query_mask: (P, K+1) boolean array, False for padding of ragged rows
+    """
+    num_neg = [len(neg_batch) for neg_batch in neg_batch_list]
+    if (min(num_neg) == max(num_neg)):
+        neg_dst = np.array(neg_batch_list, dtype=np.int64).reshape(len(neg_batch_list), -1)
+        query_dst = np.concatenate([pos_dst.reshape(-1, 1), neg_dst], axis=1)
+        return query_dst, np.ones(query_dst.shape, dtype=bool)
+
+    #* ragged rows are padded with the positive destination and masked out
+    query_dst = np.repeat(pos_dst.reshape(-1, 1), max(num_neg) + 1, axis=1)
+    query_mask = np.zeros(query_dst.shape, dtype=bool)
+    query_mask[:, 0] = True
+    for idx, neg_batch in enumerate(neg_batch_list):
+        query_dst[idx, 1:num_neg[idx] + 1] = neg_batch
+        query_mask[idx, 1:num_neg[idx] + 1] = True
+    return query_dst, query_mask
+
+
+def prefetch_neg_batches(executor, neg_sampler, edges, split_mode, snapshot_ids, window=2, pin_memory=False):
+    r"""
+    query the negatives of the snapshots in `snapshot_ids` order on a background executor,
+    so the evaluation loop does not wait on the CPU negative sampler, only `window` snapshots
+    are in flight at a time and each result is released once it has been yielded
+    Parameters:
+        executor: concurrent.futures executor running the queries
+        neg_sampler: TGB negative edge sampler with the eval set of `split_mode` loaded
+        edges: dict of snapshot id to (2, P) numpy array of positive edges
+        split_mode: 'val' or 'test'
+        snapshot_ids: snapshot ids in the order the evaluation loop consumes them
+        window: number of snapshots queried ahead, including the one being consumed
+        pin_memory: return the candidates in pinned memory for asynchronous device copies
+    Returns:
+        generator of (query_dst, query_mask) per snapshot, see `stack_neg_batch`
+        both are returned as tensors
+    """
+    def query(snapshot_idx):
+        pos_src, pos_dst = edges[snapshot_idx]
+        pos_t = np.full_like(pos_src, snapshot_idx)
+        neg_batch_list = neg_sampler.query_batch(pos_src, pos_dst, pos_t, split_mode=split_mode)
+        query_dst, query_mask = stack_neg_batch(neg_batch_list, pos_dst)
+        query_dst = torch.from_numpy(query_dst).long()
+        query_mask = torch.from_numpy(query_mask)
+        if (pin_memory):
+            query_dst = query_dst.pin_memory()
+            query_mask = query_mask.pin_memory()
+        return query_dst, query_mask
+
+    snapshot_ids = list(snapshot_ids)
+    futures = {}
+    for pos, snapshot_idx in enumerate(snapshot_ids):
+        for ahead_idx in snapshot_ids[pos:pos + window]:
+            if (ahead_idx not in futures):
+                futures[ahead_idx] = executor.submit(query, ahead_idx)
+        #* pop the future so the pinned candidates are freed once the loop moves on
+        yield futures.pop(snapshot_idx).result()
+
+
+def chunk_link_candidates(pos_index, num_nodes, chunk_size=50, num_neg=50, pow2_chunks=False):
+    r"""
+    group the positive edges of a snapshot into chunks that share one set of
+    candidate destinations: the chunk's own positive destinations followed by
+    `num_neg` uniformly sampled nodes, so a chunk is scored as one (C, C+K) block
+    Parameters:
+        pos_index: (2, E) positive edge index
+        num_nodes: number of nodes to sample negative destinations from
+        chunk_size: number of positive edges per chunk (C)
+        num_neg: number of sampled negative destinations per chunk (K)
+        pow2_chunks: pad the number of chunks to a power of two, so only a few shapes occur
+    Returns:
+        chunk_src: (B, C) source node of each positive edge
+        chunk_cand: (B, C+K) candidate destinations shared within a chunk
+        chunk_mask: (B, C, C+K) boolean, False for padding and induced positives
+    """
+    device = pos_index.device
+    num_edges = pos_index.size(1)
+    num_chunks = math.ceil(num_edges / chunk_size)
+    if (pow2_chunks):
+        num_chunks = 2 ** math.ceil(math.log2(num_chunks))
+    pad = num_chunks * chunk_size - num_edges
+
+    #* shuffle first, edges are coalesced by source and a chunk would otherwise share one source
+    perm = torch.randperm(num_edges, device=device)
+    chunk_src = F.pad(pos_index[0, perm], (0, pad)).view(num_chunks, chunk_size)
+    chunk_dst = F.pad(pos_index[1, perm], (0, pad)).view(num_chunks, chunk_size)
+    valid = (torch.arange(num_chunks * chunk_size, device=device) < num_edges).view(num_chunks, chunk_size)
+
+    neg_dst = torch.randint(0, num_nodes, (num_chunks, num_neg), dtype=torch.long, device=device)
+    chunk_cand = torch.cat([chunk_dst, neg_dst], dim=1)
+    cand_valid = torch.cat([valid, torch.ones_like(neg_dst, dtype=torch.bool)], dim=1)
+
+    #* (src_c, cand_k) is an induced positive if cand_k is the positive destination of c
+    #* or if it is the destination of another positive edge from the same source
+    induced = chunk_cand.unsqueeze(1) == chunk_dst.unsqueeze(2)
+    induced[:, :, :chunk_size] |= chunk_src.unsqueeze(1) == chunk_src.unsqueeze(2)
+    diag = torch.eye(chunk_size, chunk_size + num_neg, dtype=torch.bool, device=device)
+    chunk_mask = valid.unsqueeze(2) & cand_valid.unsqueeze(1) & (diag | ~induced)
+    return chunk_src, chunk_cand, chunk_mask
+
+
+def query_mrr(y_pred, query_mask):
+    r"""
+    reciprocal rank of every positive edge against its negatives, computed on
+    the device in one pass, ties are counted half as in the TGB evaluator
+    Parameters:
+        y_pred: (P, K+1) score tensor, column 0 is the positive edge
+        query_mask: (P, K+1) boolean tensor, False for padding
+    Returns:
+        (P,) tensor of reciprocal ranks
+    """
+    pos_pred = y_pred[:, :1]
+    neg_pred = y_pred[:, 1:]
+    neg_mask = query_mask[:, 1:]
+    optimistic = ((neg_pred > pos_pred) & neg_mask).sum(dim=1)
+    ties = ((neg_pred == pos_pred) & neg_mask).sum(dim=1)
+    rank = 1 + optimistic + 0.5 * ties
+    return 1.0 / rank